@@ -1,30 +1,160 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for
-from datamanager.data_models import db
+import time
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import jinja2
+from sqlalchemy import event, inspect, update
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.pool import QueuePool
+from flask import Flask, render_template, request, redirect
+from datamanager.data_models import db, Movie
 from datamanager.sqlite_data_manager import SQLiteDataManager
+from utils.titles import normalize_title
 
 
 app = Flask(__name__)
 data_manager = SQLiteDataManager(db)
 
+CURRENT_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
+DATABASE_URI = os.getenv(
+    'DATABASE_URI', f'sqlite:///{os.path.join(CURRENT_DIRECTORY, "data", "movieweb_db.sqlite")}'
+)
+JINJA_CACHE_DIRECTORY = os.path.join(CURRENT_DIRECTORY, '.jinja_cache')
+TEMPLATE_NAMES = (
+    'home.html', 'users.html', 'user_movies.html', 'add_user.html', 'add_movie.html',
+    'update_movie.html', '404.html', '400.html', '500.html'
+)
+TEMPLATES = {}
+SLOW_QUERY_SECONDS = 0.02
+
+_log_listener = None
+
+# The redirect target after every movie change is fixed, so the URL map is bound once instead of per url_for() call
+_build_url = app.url_map.bind('').build
+
+
+def configure_logging():
+    """Sends log records through a queue to a background thread that writes them.
+
+    Request and executor threads only put records on the queue, the blocking
+    write to stderr happens on the QueueListener's thread.  Only the first call
+    has an effect.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+    _log_listener = QueueListener(log_queue, stream_handler)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
 
 def configure_app(app):
     """Configures the Flask application.
 
-    Sets the database URI based on the DATABASE_URI environment variable or
-    defaults to a SQLite database file in the 'data' directory.  Disables
-    SQLAlchemy's modification tracking.
+    Sets the database URI read from the DATABASE_URI environment variable at
+    import, defaulting to a SQLite database file in the 'data' directory.
+    Disables SQLAlchemy's modification tracking and sizes the connection pool.
+    SQLite connections run in WAL mode, see set_sqlite_pragmas().  In debug
+    mode, lazy loads and slow queries are logged, see enable_query_diagnostics().
+    Compiled templates are cached on disk in '.jinja_cache' and compiled once
+    at startup.  Logging is set up with configure_logging().
 
     Args:
         app: The Flask application instance.
     """
-    current_directory = os.path.abspath(os.path.dirname(__file__))
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
-        'DATABASE_URI', f'sqlite:///{os.path.join(current_directory, "data", "movieweb_db.sqlite")}'
-    )
+    configure_logging()
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'query_cache_size': 1000,
+        'echo': False,
+        'future': True
+    }
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'check_same_thread': False}
     db.init_app(app)
 
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+        if app.debug:
+            enable_query_diagnostics(app)
+
+    os.makedirs(JINJA_CACHE_DIRECTORY, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory=JINJA_CACHE_DIRECTORY)
+    if not app.debug:
+        app.jinja_env.auto_reload = False
+    for template_name in TEMPLATE_NAMES:
+        TEMPLATES[template_name] = app.jinja_env.get_template(template_name)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tunes every new SQLite connection.
+
+    WAL lets readers proceed while a write is in progress and turns commits
+    into sequential appends, with synchronous=NORMAL fsyncing only at
+    checkpoints.
+
+    Args:
+        dbapi_connection: The raw sqlite3 connection.
+        connection_record: The pool's record for the connection (unused).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.close()
+
+
+def enable_query_diagnostics(app):
+    """Logs lazy relationship loads and slow queries, meant for debug mode.
+
+    Lazy loads are how N+1 query patterns show up, so each one is logged with
+    the relationship that triggered it.  Queries slower than SLOW_QUERY_SECONDS
+    are logged with SQLite's EXPLAIN QUERY PLAN output, which points out
+    missing indexes.  Has to be called in an app context.
+
+    Args:
+        app: The Flask application instance.
+    """
+    def log_lazy_load(orm_execute_state):
+        if orm_execute_state.is_relationship_load and orm_execute_state.lazy_loaded_from is not None:
+            app.logger.warning("Lazy load (possible N+1 query) from %s", orm_execute_state.lazy_loaded_from.object)
+
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_times'].pop()
+        if elapsed < SLOW_QUERY_SECONDS:
+            return
+        app.logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement)
+        if conn.dialect.name == 'sqlite' and statement.lstrip().upper().startswith('SELECT') and not executemany:
+            query_plan = cursor.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+            app.logger.warning("Query plan: %s", query_plan)
+
+    event.listen(db.session, 'do_orm_execute', log_lazy_load)
+    event.listen(db.engine, 'before_cursor_execute', start_query_timer)
+    event.listen(db.engine, 'after_cursor_execute', log_slow_query)
+
 
 def create_database(app, db):
     """Creates the database tables if they don't exist.
@@ -41,6 +171,113 @@ def create_database(app, db):
         db.create_all()
 
 
+def create_missing_columns(app, db):
+    """Adds columns that are missing from already existing database tables.
+
+    db.create_all() does not alter existing tables, so columns added to the
+    models later are added here with ALTER TABLE.  New columns need a server
+    default if they are not nullable.
+
+    Args:
+        app: The Flask application instance.
+        db: The SQLAlchemy database object.
+    """
+    with app.app_context():
+        inspector = inspect(db.engine)
+        with db.engine.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column_ddl}')
+
+
+def backfill_title_keys(app, db):
+    """Fills in the normalized title_key of movies stored before the column existed.
+
+    Args:
+        app: The Flask application instance.
+        db: The SQLAlchemy database object.
+    """
+    with app.app_context():
+        movies = db.session.query(Movie).filter(Movie.title_key.is_(None)).all()
+        for movie in movies:
+            movie.title_key = normalize_title(movie.title)
+        db.session.commit()
+
+
+def fail_pending_movies(app, db):
+    """Marks movies that are still pending from a previous run as failed.
+
+    Their background OMDb lookups were lost when the process stopped, e.g. by
+    the reloader in debug mode.  Adding the title again fetches the details again.
+
+    Args:
+        app: The Flask application instance.
+        db: The SQLAlchemy database object.
+    """
+    with app.app_context():
+        db.session.execute(
+            update(Movie).where(Movie.status == 'pending').values(status='failed')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+
+def create_indexes(app, db):
+    """Creates missing indexes on already existing database tables.
+
+    db.create_all() only creates indexes together with new tables, so indexes
+    added to the models later are created here.  Runs ANALYZE afterwards so
+    SQLite's query planner picks them up.
+
+    Args:
+        app: The Flask application instance.
+        db: The SQLAlchemy database object.
+    """
+    with app.app_context():
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('ANALYZE')
+
+
+def render_cached(template_name, **context):
+    """Renders a template compiled at startup.
+
+    Skips Flask's per-request template lookup.  While templates auto-reload
+    (debug mode) or before configure_app() ran, falls back to render_template().
+
+    Args:
+        template_name: The name of the template, one of TEMPLATE_NAMES.
+        **context: The variables passed to the template.
+
+    Returns:
+        The rendered template as a string.
+    """
+    if app.jinja_env.auto_reload or template_name not in TEMPLATES:
+        return render_template(template_name, **context)
+    app.update_template_context(context)
+    return TEMPLATES[template_name].render(context)
+
+
+def user_movies_url(user_id, action_result):
+    """Builds the URL of a user's movie list.
+
+    Args:
+        user_id: The ID of the user.
+        action_result: The message shown on the page, left out if None.
+
+    Returns:
+        The path of the 'list_user_movies' view including the query string.
+    """
+    return _build_url('list_user_movies', {'user_id': user_id, 'action_result': action_result})
+
+
 @app.route('/')
 def home():
     """Renders the home page.
@@ -48,7 +285,7 @@ def home():
     Returns:
         A tuple containing the rendered 'home.html' template and a 200 status code.
     """
-    return render_template('home.html'), 200
+    return render_cached('home.html'), 200
 
 
 @app.route('/users')
@@ -62,7 +299,7 @@ def list_users():
         A tuple containing the rendered 'users.html' template and a 200 status code.
     """
     users = data_manager.get_all_users()
-    return render_template('users.html', users=users), 200
+    return render_cached('users.html', users=users), 200
 
 
 @app.route('/users/<int:user_id>')
@@ -83,8 +320,8 @@ def list_user_movies(user_id):
     action_result = request.args.get('action_result')
     user_movies = data_manager.get_user_movies(user_id)
     if user_movies == "error":
-        return render_template('404.html'), 404
-    return render_template('user_movies.html', user_movies=user_movies, user=user, user_id=user_id,
+        return render_cached('404.html'), 404
+    return render_cached('user_movies.html', user_movies=user_movies, user=user, user_id=user_id,
                            action_result=action_result), 200
 
 
@@ -100,15 +337,15 @@ def add_user():
         A tuple containing the rendered template and status code.
     """
     if request.method == 'GET':
-        return render_template('add_user.html'), 200
+        return render_cached('add_user.html'), 200
 
     if request.method == 'POST':
         username = request.form['username']
         new_user = data_manager.add_user(username)
         if new_user:
-            return render_template('add_user.html', user_used=new_user), 200
+            return render_cached('add_user.html', user_used=new_user), 200
         success_message = f"User '{username}' has successfully been created."
-        return render_template('home.html', success_message=success_message), 201
+        return render_cached('home.html', success_message=success_message), 201
 
 
 @app.route('/users/<int:user_id>/add_movie', methods=['GET', 'POST'])
@@ -126,12 +363,12 @@ def add_movie_to_user(user_id):
         A redirect to the user's movie list.
     """
     if request.method == 'GET':
-        return render_template('add_movie.html', user_id=user_id), 200
+        return render_cached('add_movie.html', user_id=user_id), 200
 
     if request.method == 'POST':
         movie_name = request.form['movie_name']
         action_result = data_manager.add_movie_to_user(user_id, movie_name)
-        return redirect(url_for('list_user_movies', action_result=action_result, user_id=user_id))
+        return redirect(user_movies_url(user_id, action_result))
 
 
 @app.route('/users/<int:user_id>/update_movie/<int:movie_id>', methods=['GET', 'POST'])
@@ -154,9 +391,9 @@ def update_movie(movie_id, user_id):
         user = data_manager.get_user(user_id)
         movie = data_manager.get_movie(movie_id)
         if user == "error" or movie == "error":
-            return render_template('404.html'), 404
+            return render_cached('404.html'), 404
 
-        return render_template('update_movie.html', user=user, movie=movie)
+        return render_cached('update_movie.html', user=user, movie=movie)
 
     if request.method == 'POST':
         new_title = request.form['title']
@@ -164,7 +401,7 @@ def update_movie(movie_id, user_id):
         new_publication_year = request.form['publication_year']
         new_rating = request.form['rating']
         action_result = data_manager.update_movie(user_id, movie_id, new_title, new_director, new_publication_year, new_rating)
-        return redirect(url_for('list_user_movies', action_result=action_result, user_id=user_id))
+        return redirect(user_movies_url(user_id, action_result))
 
 
 @app.route('/users/<int:user_id>/remove_movie/<int:movie_id>', methods=['POST'])
@@ -181,32 +418,37 @@ def remove_movie_from_user(movie_id, user_id):
         A redirect to the user's movie list.
     """
     action_result = data_manager.remove_movie_from_user(movie_id, user_id)
-    return redirect(url_for('list_user_movies', action_result=action_result, user_id=user_id))
+    return redirect(user_movies_url(user_id, action_result))
 
 
 @app.errorhandler(400)
 def internal_server_error(e):
     """Handles 400 Bad Request errors."""
-    return render_template('400.html', e=e), 400
+    return render_cached('400.html', e=e), 400
 
 
 @app.errorhandler(404)
 def page_not_found(e):
     """Handles 404 Page Not Found errors."""
-    return render_template('404.html', e=e), 404
+    return render_cached('404.html', e=e), 404
 
 
 @app.errorhandler(500)
 def internal_server_error(e):
     """Handles 500 Internal Server Error errors."""
-    return render_template('500.html', e=e), 500
+    return render_cached('500.html', e=e), 500
 
 
 if __name__ == "__main__":
+    app.debug = True
     configure_app(app)
+    create_missing_columns(app, db)
+    backfill_title_keys(app, db)
+    fail_pending_movies(app, db)
+    create_indexes(app, db)
 
     #db_path = os.path.join(os.path.dirname(__file__), "data", "movieweb_db.sqlite")
     #if not os.path.exists(db_path):
     #    create_database(app, db)
 
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000)
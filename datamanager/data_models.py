@@ -1,13 +1,17 @@
 from flask_sqlalchemy import SQLAlchemy
+from utils.titles import normalize_title
 
 
 db = SQLAlchemy()
 
+
 # Relational table to avoid a movie being added for each user
 movie_user_rel  = db.Table(
     'movie_user_rel',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id'), primary_key=True)
+    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id'), primary_key=True),
+    # The primary key leads with user_id, this index serves lookups by movie (movie.users, orphan checks)
+    db.Index('ix_movie_user_rel_movie_id_user_id', 'movie_id', 'user_id')
 )
 
 class User(db.Model):
@@ -29,19 +33,24 @@ class Movie(db.Model):
     Movie Table with the following columns:
     - id [PrimaryKey]
     - title
+    - title_key [normalized title for lookups, see normalize_title()]
     - director
     - release_year
     - imdb_rating
     - poster_url
+    - status ['pending' while the OMDb details are fetched, 'ready' or 'failed']
     """
     __tablename__ = 'movies'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    title = db.Column(db.String, nullable=False)
+    title = db.Column(db.String, nullable=False, index=True)
+    title_key = db.Column(db.String, nullable=True, index=True,
+                          default=lambda context: normalize_title(context.get_current_parameters()['title']))
     director = db.Column(db.String, nullable=False)
-    release_year = db.Column(db.Integer, nullable=False)
+    release_year = db.Column(db.Integer, nullable=False, index=True)
     imdb_rating = db.Column(db.Float, nullable=False)
     poster_url = db.Column(db.String, nullable=True)
+    status = db.Column(db.String, nullable=False, default='ready', server_default='ready')
 
     users = db.relationship('User', secondary=movie_user_rel, back_populates='movies')
 
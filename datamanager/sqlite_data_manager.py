@@ -1,9 +1,55 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import select, insert, update, delete, exists, func, and_, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
 from datamanager.data_manager_interface import DataManager
-from datamanager.data_models import User, Movie
+from datamanager.data_models import User, Movie, movie_user_rel
+from utils.titles import normalize_title
 from omdb_api.omdb_api import request_movie_data
 
 
+log = logging.getLogger(__name__)
+
+# Fetches OMDb details for newly added movies outside the request
+_executor = ThreadPoolExecutor(max_workers=8)
+
+# Statements for the hot lookups are built once, so each call only binds parameters and hits the compiled cache
+_GET_USER = select(User).where(User.id == bindparam('id'))
+_GET_MOVIE = select(Movie).where(Movie.id == bindparam('id'))
+_GET_USER_MOVIES = select(Movie).join(movie_user_rel).where(movie_user_rel.c.user_id == bindparam('user_id'))
+# Known movies with the title, each with user_id set if the user already has it in their collection
+_GET_KNOWN_MOVIES = select(Movie.id, Movie.status, movie_user_rel.c.user_id) \
+    .outerjoin(movie_user_rel, and_(movie_user_rel.c.movie_id == Movie.id,
+                                    movie_user_rel.c.user_id == bindparam('user_id'))) \
+    .where(Movie.title_key == bindparam('title_key'))
+# Existence checks only fetch a single column, no ORM objects are built
+_USER_EXISTS = select(User.id).where(User.id == bindparam('id'))
+_GET_MOVIE_TITLE = select(Movie.title).where(Movie.id == bindparam('id'))
+
+
+def _coerce(value, cast, default=None):
+    """Casts a submitted form value, falling back to a default.
+
+    Blank values return the default without going through a failing cast.
+
+    Args:
+        value: The value to cast, usually a string from a form.
+        cast: The type to cast to, e.g. int or float.
+        default: Returned if the value is blank or can't be cast.
+
+    Returns:
+        The cast value or the default.
+    """
+    if value is None or value == '':
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
 class SQLiteDataManager(DataManager):
     """Manages data persistence using SQLite for users and movies."""
     def __init__(self, db):
@@ -17,17 +63,24 @@ class SQLiteDataManager(DataManager):
     def get_all_users(self) -> list:
         """Retrieves all users from the database.
 
+        Only the id and name columns are loaded, no User objects are built.  The number
+        of movies per user is counted in the same query.
+
         Returns:
-            A list of User objects.  Returns an empty list if no users are found.
+            A list of rows with id, name and movie_count attributes.  Returns an empty list if no users are found.
             Returns None and logs the error if a SQLAlchemyError occurs.
         """
         try:
-            all_users_list = self.db.session.query(User).all()
+            all_users_list = self.db.session.execute(
+                select(User.id, User.name, func.count(movie_user_rel.c.movie_id).label('movie_count'))
+                .outerjoin(movie_user_rel, movie_user_rel.c.user_id == User.id)
+                .group_by(User.id)
+            ).all()
             return all_users_list
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while retrieving users: {e}")
+            log.exception("Error while retrieving users")
 
     def get_user(self, user_id):
         """Retrieves a specific user by ID.
@@ -39,15 +92,14 @@ class SQLiteDataManager(DataManager):
             A User object if found, None otherwise. Returns "error" if there is a SQLAlchemyError.
         """
         try:
-            user = self.db.session.query(User) \
-            .filter(User.id == user_id).first()
+            user = self.db.session.execute(_GET_USER, {'id': user_id}).scalar_one_or_none()
             if not user:
                 return "error"
             return user
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while fetching User: {e}")
+            log.exception("Error while fetching User")
 
     def get_all_movies(self) -> list:
         """Retrieves all movies from the database.
@@ -59,13 +111,16 @@ class SQLiteDataManager(DataManager):
             all_movies_list = self.db.session.query(Movie).all()
             return all_movies_list
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while retrieving movies: {e}")
+            log.exception("Error while retrieving movies")
 
     def get_user_movies(self, user_id) -> list:
         """Retrieves all movies associated with a specific user.
 
+        The movies are selected through the association table in one query, the user's
+        existence is only checked when that query comes back empty.
+
         Args:
             user_id: The ID of the user.
 
@@ -73,10 +128,10 @@ class SQLiteDataManager(DataManager):
             A list of Movie objects associated with the user. Raises a ValueError if the user is not found.
             Returns an empty list if the user has no movies.
         """
-        user = self.db.session.query(User).get(user_id)
-        if not user:
+        user_movies = self.db.session.execute(_GET_USER_MOVIES, {'user_id': user_id}).scalars().all()
+        if not user_movies and not self.db.session.execute(_USER_EXISTS, {'id': user_id}).scalar():
             raise ValueError(f"Theres no User with ID: {user_id}.")
-        return user.movies
+        return user_movies
 
     def get_movie(self, movie_id):
         """Retrieves a specific movie by ID.
@@ -88,15 +143,14 @@ class SQLiteDataManager(DataManager):
             A Movie object if found, None otherwise. Returns "error" if there is a SQLAlchemyError.
         """
         try:
-            movie = self.db.session.query(Movie) \
-            .filter(Movie.id == movie_id).first()
+            movie = self.db.session.execute(_GET_MOVIE, {'id': movie_id}).scalar_one_or_none()
             if not movie:
                 return "error"
             return movie
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while fetching movie: {e}")
+            log.exception("Error while fetching movie")
 
     def add_user(self, new_username) -> str:
         """Adds a new user to the database.
@@ -118,14 +172,17 @@ class SQLiteDataManager(DataManager):
             self.db.session.commit()
             return f"{new_username} added as a new user."
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while trying to add a new user to database: {e}")
+            log.exception("Error while trying to add a new user to database")
 
     def add_movie_to_user(self, user_id, title) -> str:
         """Adds a movie to a user's collection.
 
-        Retrieves movie data from the OMDb API if the movie doesn't exist in the database.
+        Known movies are matched on their normalized title, so differences in case and
+        whitespace don't cause another OMDb request.  If the movie doesn't exist in the
+        database, a pending movie is added right away and its data is retrieved from the
+        OMDb API in the background, see _enrich_movie.
 
         Args:
             user_id: The ID of the user.
@@ -136,50 +193,124 @@ class SQLiteDataManager(DataManager):
         Raises:
             ValueError: If the user is not found.
         """
+        title = title.strip()
+        if not title:
+            return "Please enter a movie title."
+
         try:
-            user = self.db.session.query(User).get(user_id)
-            if not user:
-                raise ValueError(f"Theres no User with ID: {user_id}.")
+            # Re-adding a movie the user already has is answered by this single query
+            known_movies = self.db.session.execute(_GET_KNOWN_MOVIES,
+                                                {'user_id': user_id, 'title_key': normalize_title(title)}).all()
+            linked_movies = [movie for movie in known_movies if movie.user_id is not None]
+            if any(movie.status != 'failed' for movie in linked_movies):
+                return f"{title} already exists in your list of movies."
+            if linked_movies:
+                # The user already has this title as a failed lookup, fetch it again instead of adding another row
+                failed_movie_id = linked_movies[0].id
+                self.db.session.execute(
+                    update(Movie).where(Movie.id == failed_movie_id, Movie.status == 'failed')
+                    .values(status='pending')
+                    .execution_options(synchronize_session=False)
+                )
+                self.db.session.commit()
+                # OMDb answers unknown titles with a cached response, the retry requests the title again
+                _executor.submit(self._enrich_movie, current_app._get_current_object(), failed_movie_id, title, True)
+                return f"{title} is already in your list of movies, fetching details again."
 
-            known_movie = self.db.session.query(Movie).filter(Movie.title == title).first()
-            if known_movie:
-                if known_movie not in user.movies:
-                    user.movies.append(known_movie)
-                    self.db.session.commit()
-                    return f"{title} added to your list of movies."
-                else:
-                    return f"{title} already exists in your list of movies."
+            if not self.db.session.execute(_USER_EXISTS, {'id': user_id}).scalar():
+                raise ValueError(f"Theres no User with ID: {user_id}.")
 
-            res = request_movie_data(title)
-            if isinstance(res, tuple) and len(res) == 5:
-                fetched_title, fetched_director, fetched_release_year, fetched_imdb_rating, fetched_poster_url = res
-            else:
-                return "Data is invalid"
-
-            new_movie = Movie(
-                title = fetched_title,
-                director = fetched_director,
-                release_year = fetched_release_year,
-                imdb_rating = fetched_imdb_rating,
-                poster_url = fetched_poster_url
+            # Failed lookups of other users are not linked, the user gets a new pending movie instead
+            linkable_movies = [movie for movie in known_movies if movie.status != 'failed']
+            if linkable_movies:
+                # A concurrent add of the same movie may have linked it already
+                self.db.session.execute(
+                    sqlite_insert(movie_user_rel).values(user_id=user_id, movie_id=linkable_movies[0].id)
+                    .on_conflict_do_nothing()
+                )
+                self.db.session.commit()
+                return f"{title} added to your list of movies."
+
+            new_movie_id = self.db.session.execute(
+                insert(Movie).values(
+                    title = title,
+                    director = '?',
+                    release_year = 0,
+                    imdb_rating = 0,
+                    poster_url = None,
+                    status = 'pending'
+                )
+            ).inserted_primary_key[0]
+            self.db.session.execute(
+                insert(movie_user_rel).values(user_id=user_id, movie_id=new_movie_id)
             )
-            user.movies.append(new_movie)
             self.db.session.commit()
-            return f"{title} added to your list of movies."
+            _executor.submit(self._enrich_movie, current_app._get_current_object(), new_movie_id, title)
+            return f"{title} added to your list of movies, fetching details."
 
         except ValueError as e:
             self.db.session.rollback()
-            print(f"Error: {e}")
+            log.warning("Error: %s", e)
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while trying to add a new movie to database: {e}")
+            log.exception("Error while trying to add a new movie to database")
+
+    def _enrich_movie(self, app, movie_id, title, force_refresh=False):
+        """Fills in a pending movie with the data retrieved from the OMDb API.
+
+        Runs on the background executor, where nothing reads the returned future, so every
+        error is caught and logged here.  Marks the movie as 'failed' if no valid data is
+        found or the lookup raised, and leaves it alone if it was removed or edited in the
+        meantime.
+
+        Args:
+            app: The Flask application, to run in its app context.
+            movie_id: The ID of the pending movie.
+            title: The title to look up.
+            force_refresh: Whether to bypass the cached OMDb responses, used when retrying failed movies.
+        """
+        try:
+            res = request_movie_data(title, force_refresh)
+            if isinstance(res, tuple) and len(res) == 5:
+                fetched_title, fetched_director, fetched_release_year, fetched_imdb_rating, fetched_poster_url = res
+                movie_details = {
+                    'title': fetched_title,
+                    'title_key': normalize_title(fetched_title),
+                    'director': fetched_director,
+                    'release_year': fetched_release_year,
+                    'imdb_rating': fetched_imdb_rating,
+                    'poster_url': fetched_poster_url,
+                    'status': 'ready'
+                }
+            else:
+                log.warning("Data is invalid for '%s': %s", title, res)
+                movie_details = {'status': 'failed'}
+
+        except Exception:
+            log.exception("Error while trying to fetch OMDb data for '%s'", title)
+            movie_details = {'status': 'failed'}
+
+        with app.app_context():
+            try:
+                # The status condition skips movies that were edited while the data was fetched
+                self.db.session.execute(
+                    update(Movie).where(Movie.id == movie_id, Movie.status == 'pending').values(**movie_details)
+                    .execution_options(synchronize_session=False)
+                )
+                self.db.session.commit()
+
+            except Exception:
+                # Movies left pending here are marked as failed on the next start, see fail_pending_movies
+                self.db.session.rollback()
+                log.exception("Error while trying to update movie with OMDb data")
 
     def update_movie(self, user_id, movie_id, title=None, director=None, release_year=None, imdb_rating=None) -> str:
         """Updates movie details for a user.
 
-        Creates a new movie entry to prevent details from being edited for all users.
-        If no other user has the old movie in their collection, it is also removed.
+        If no other user has the movie in their collection, it is updated in place.
+        Otherwise a new movie entry is created for this user, to prevent details from
+        being edited for all users, and the user's link is moved over to it.
 
         Args:
             user_id: ID of the user whose movie is updated.
@@ -196,25 +327,20 @@ class SQLiteDataManager(DataManager):
             TypeError: If the provided title or director are not strings.
         """
         try:
-            movie = self.db.session.query(Movie).get(movie_id)
-            user = self.db.session.query(User).get(user_id)
+            movie = self.db.session.get(Movie, movie_id)
 
             if not movie:
                 raise ValueError(f"There is no movie with id: {movie_id}")
-            if not user:
+            if not self.db.session.execute(_USER_EXISTS, {'id': user_id}).scalar():
                 raise ValueError(f"There is no user with id: {user_id}")
 
             new_title = title
             new_director = director
-            try:
-                new_release_year = int(release_year)
-            except ValueError as e:
-                print(f"Error: {e}")
+            new_release_year = _coerce(release_year, int)
+            if new_release_year is None:
                 new_release_year = movie.release_year
-            try:
-                new_rating = float(imdb_rating)
-            except ValueError as e:
-                print(f"Error: {e}")
+            new_rating = _coerce(imdb_rating, float)
+            if new_rating is None:
                 new_rating = movie.imdb_rating
 
             if not isinstance(new_title, str):
@@ -222,29 +348,49 @@ class SQLiteDataManager(DataManager):
             if not isinstance(new_director, str):
                 raise TypeError(f"Expected string for director, got {type(new_director)} instead.")
 
-            self.delete_movie(movie_id, user_id)
-            new_movie = Movie(
-                title = new_title,
-                director = new_director,
-                release_year = new_release_year,
-                imdb_rating = new_rating,
-                poster_url = movie.poster_url
+            old_title = movie.title
+            other_users_count = self.db.session.scalar(
+                select(func.count()).select_from(movie_user_rel)
+                .where(movie_user_rel.c.movie_id == movie_id, movie_user_rel.c.user_id != user_id)
             )
-            user.movies.append(new_movie)
+            movie_details = {
+                'title': new_title,
+                'title_key': normalize_title(new_title),
+                'director': new_director,
+                'release_year': new_release_year,
+                'imdb_rating': new_rating,
+                'status': 'ready'
+            }
+            if other_users_count == 0:
+                self.db.session.execute(
+                    update(Movie).where(Movie.id == movie_id).values(**movie_details)
+                    .execution_options(synchronize_session=False)
+                )
+            else:
+                new_movie_id = self.db.session.execute(
+                    insert(Movie).values(poster_url=movie.poster_url, **movie_details).returning(Movie.id)
+                ).scalar_one()
+                self.db.session.execute(
+                    delete(movie_user_rel)
+                    .where(movie_user_rel.c.user_id == user_id, movie_user_rel.c.movie_id == movie_id)
+                )
+                self.db.session.execute(
+                    insert(movie_user_rel).values(user_id=user_id, movie_id=new_movie_id)
+                )
             self.db.session.commit()
-            return f"{movie.title} updated!"
+            return f"{old_title} updated!"
 
         except ValueError as e:
             self.db.session.rollback()
-            print(e)
+            log.warning("%s", e)
 
         except TypeError as e:
             self.db.session.rollback()
-            print(e)
+            log.warning("%s", e)
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(e)
+            log.exception("Error while trying to update movie")
 
     def remove_movie_from_user(self, movie_id, user_id):
         """Removes a movie from a user's collection.
@@ -261,27 +407,22 @@ class SQLiteDataManager(DataManager):
             ValueError: If the movie or user is not found.
         """
         try:
-            movie = self.db.session.query(Movie).get(movie_id)
-            if not movie:
+            movie_title = self.db.session.execute(_GET_MOVIE_TITLE, {'id': movie_id}).scalar()
+            if movie_title is None:
                 raise ValueError(f"Movie with ID {movie_id} not found.")
-            user = self.db.session.query(User).get(user_id)
-            if not user:
+            if not self.db.session.execute(_USER_EXISTS, {'id': user_id}).scalar():
                 raise ValueError(f"User with ID {user_id} not found.")
 
-            if movie in user.movies:
-                user.movies.remove(movie)
-                self.db.session.commit()
-            if len(movie.users) == 0:
-                self.db.session.delete(movie)
-                self.db.session.commit()
-            return f"Successfully removed '{movie.title}' from your list."
+            self._unlink_movie(movie_id, user_id)
+            self.db.session.commit()
+            return f"Successfully removed '{movie_title}' from your list."
 
         except ValueError as e:
             self.db.session.rollback()
-            print(e)
-        except SQLAlchemyError as e:
+            log.warning("%s", e)
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while removing movie: {e}")
+            log.exception("Error while removing movie")
 
     def delete_movie(self, movie_id, user_id) -> str:
         """Deletes a movie from a user's collection and potentially from the database.
@@ -299,28 +440,42 @@ class SQLiteDataManager(DataManager):
             ValueError: If the movie or user is not found.
         """
         try:
-            movie = self.db.session.query(Movie).get(movie_id)
-            user = self.db.session.query(User).get(user_id)
-
-            if not movie:
+            movie_title = self.db.session.execute(_GET_MOVIE_TITLE, {'id': movie_id}).scalar()
+            if movie_title is None:
                 raise ValueError(f"There is no movie with id: {movie_id}")
-            if not user:
+            if not self.db.session.execute(_USER_EXISTS, {'id': user_id}).scalar():
                 raise ValueError(f"There is no user with id: {user_id}")
 
-            if movie in user.movies:
-                user.movies.remove(movie)
-                self.db.session.commit()
-
-            if not movie.users:
-                self.db.session.delete(movie)
-                self.db.session.commit()
-
-            return f"{movie} has been removed from your list."
+            self._unlink_movie(movie_id, user_id)
+            self.db.session.commit()
+            return f"{movie_title} has been removed from your list."
 
         except ValueError as e:
             self.db.session.rollback()
-            print(e)
+            log.warning("%s", e)
 
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             self.db.session.rollback()
-            print(f"Error while trying to remove movie from database: {e}")
+            log.exception("Error while trying to remove movie from database")
+
+    def _unlink_movie(self, movie_id, user_id):
+        """Removes a movie from a user's collection without loading either of them.
+
+        Deletes the association row, then deletes the movie itself if no other user
+        has it in their collection.  The second statement is skipped if the user didn't
+        have the movie.  The caller commits.
+
+        Args:
+            movie_id: The ID of the movie to remove.
+            user_id: The ID of the user.
+        """
+        unlinked = self.db.session.execute(
+            delete(movie_user_rel)
+            .where(movie_user_rel.c.user_id == user_id, movie_user_rel.c.movie_id == movie_id)
+        )
+        if unlinked.rowcount:
+            self.db.session.execute(
+                delete(Movie)
+                .where(Movie.id == movie_id, ~exists().where(movie_user_rel.c.movie_id == movie_id))
+                .execution_options(synchronize_session=False)
+            )
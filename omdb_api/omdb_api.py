@@ -1,39 +1,114 @@
 import os
+import re
+import threading
 from dotenv import load_dotenv
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.titles import normalize_title
 
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
+OMDB_URL = 'https://www.omdbapi.com/'
+MOVIE_DATA_CACHE_SIZE = 4096
+CACHE_NAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "omdb_cache")
 
+# Responses are cached for a day in a SQLite file; the API key is kept out of the cache keys and stored responses.
+# The cache runs in WAL mode like the app database, background fetches write to it while requests read from it
+_session = requests_cache.CachedSession(
+    cache_name=CACHE_NAME,
+    backend='sqlite',
+    expire_after=86400,
+    ignored_parameters=['apikey'],
+    check_same_thread=False,
+    wal=True,
+    busy_timeout=30000
+)
+# Parsed results of found movies per normalized title, "not found" answers are left to the response cache's expiry.
+# The background executor's threads share it, so it is only read and changed while holding the lock
+_movie_data_cache = {}
+_movie_data_cache_lock = threading.Lock()
+# Keeps connections to OMDb alive across requests instead of a new TCP and TLS handshake per lookup.
+# Rate limits and server errors are retried with exponential backoff, the last response is returned as is
+_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods={'GET'},
+        raise_on_status=False
+    )
+))
 
-def request_movie_data(title: str) -> tuple[str, str, int, float, str]|str:
+
+def request_movie_data(title: str, force_refresh: bool = False) -> tuple[str, str, int, float, str]|str:
     """
     Fetches movie details from the OMDb API for the given title.
+    Found movies are kept in memory per normalized (lowercase, single-spaced)
+    title, all responses are cached on disk for a day.  Failed requests are not
+    cached.  Empty titles are rejected without a request.  force_refresh skips
+    both caches, e.g. to retry a title OMDb didn't find before.
 
     :param title: The title of the movie to search for.
+    :param force_refresh: Whether to request the movie even if a response is cached.
     :return: A tuple containing (title, director, release year, IMDb rating, poster URL) or an error message.
     """
-    try:
-        url = f'http://www.omdbapi.com/?apikey={API_KEY}&t={title.strip()}'
-
-        res = requests.get(url)
+    normalized_title = normalize_title(title)
+    if not normalized_title:
+        return "Error: No movie title given!"
 
-        if res.status_code == 200:
-            movie_details = res.json()
+    if not force_refresh:
+        with _movie_data_cache_lock:
+            cached_result = _movie_data_cache.get(normalized_title)
+        if cached_result is not None:
+            return cached_result
 
-            if movie_details.get('Response') == 'True':
-                title = movie_details.get('Title', 'N/A')
-                director = movie_details.get('Director', 'N/A')
-                year = int(movie_details.get('Year', 0))
-                imdb_rating = float(movie_details.get('imdbRating', 0.0))
-                poster_url = movie_details.get('Poster', 'N/A')
+    try:
+        result = _fetch_movie_data(normalized_title, force_refresh)
+        if isinstance(result, tuple):
+            with _movie_data_cache_lock:
+                if len(_movie_data_cache) >= MOVIE_DATA_CACHE_SIZE:
+                    _movie_data_cache.pop(next(iter(_movie_data_cache)), None)
+                _movie_data_cache[normalized_title] = result
+        return result
 
-                return title, director, year, imdb_rating, poster_url
-            else:
-                return f"Error: {movie_details.get('Error', 'Movie not found!')}"
-        else:
-            return f"HTTP Error: {res.status_code}"
+    except requests.HTTPError as e:
+        return f"HTTP Error: {e.response.status_code}"
 
     except requests.RequestException as e:
         return f"Request Exception: {e}"
+
+
+def _fetch_movie_data(normalized_title: str, force_refresh: bool = False) -> tuple[str, str, int, float, str]|str:
+    """
+    Fetches and parses the OMDb API response for an already normalized title.
+
+    :param normalized_title: The lowercase, single-spaced title to search for.
+    :param force_refresh: Whether to bypass the cached response.
+    :return: A tuple containing (title, director, release year, IMDb rating, poster URL) or an error message.
+    :raises requests.RequestException: If the request fails or returns an HTTP error status.
+    """
+    res = _session.get(OMDB_URL, params={'apikey': API_KEY, 't': normalized_title}, timeout=(2, 5),
+                       force_refresh=force_refresh)
+    res.raise_for_status()
+    movie_details = res.json()
+
+    if movie_details.get('Response') == 'True':
+        title = movie_details.get('Title', 'N/A')
+        director = movie_details.get('Director', 'N/A')
+        # Series have year ranges like '2008–2013', unrated titles have 'N/A' as rating
+        year_match = re.match(r'\d{4}', movie_details.get('Year', ''))
+        year = int(year_match.group()) if year_match else 0
+        try:
+            imdb_rating = float(movie_details.get('imdbRating', 0.0))
+        except ValueError:
+            imdb_rating = 0.0
+        poster_url = movie_details.get('Poster', 'N/A')
+
+        return title, director, year, imdb_rating, poster_url
+    else:
+        return f"Error: {movie_details.get('Error', 'Movie not found!')}"
@@ -0,0 +1,3 @@
+def normalize_title(title):
+    """Returns the lookup key for a movie title: lowercase with single spaces."""
+    return ' '.join(title.split()).lower()